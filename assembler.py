@@ -2,23 +2,18 @@
 import sys
 import getopt
 import io
+import multiprocessing
 import re
 import struct
 
-#Special API pointer addresses
-APIGetMyAddress = 0x0001
-APIGetRelativeOffset = 0x0002
-APIPrepareTable = 0x0003
-APIGetTableValue = 0x0004
-APIRestoreOldTable = 0x0005
-APIGetSymbol = 0x0006
-APIGetVar = 0x0007#not implemented yet in Relative Offset API version 0.3
-APIPICTemp = 0x001B#not implemented yet either
+from mar_tables import *
+
 def printUsage():
-    print("assembler.py input_file [--pdc] [--dcl] [--raw_asm]")
+    print("assembler.py input_file [--pdc] [--dcl] [--raw_asm] [--jobs n]")
     print("    pdc: force code to be position-dependent")
     print("    dcl: give output as DC.L statements so it can be \n         pasted into MAR (defaults to raw output)")
     print("    raw_asm: disable object file and output raw code")
+    print("    jobs: assemble the input in chunks using n worker processes")
 
 if(len(sys.argv) < 2):
     printUsage()
@@ -27,9 +22,10 @@ if(len(sys.argv) < 2):
 pic_default = True
 dcl_mode = False
 wrap_asm = True
+jobs = 1
 
 try:
-    opts, args = getopt.getopt(sys.argv[2:], "p:d:r", ["pdc", "dcl", "raw_asm"])
+    opts, args = getopt.getopt(sys.argv[2:], "p:d:rj:", ["pdc", "dcl", "raw_asm", "jobs="])
 except getopt.GetoptError:
     printUsage()
     sys.exit(2)
@@ -41,6 +37,12 @@ for opt, arg in opts:
         dcl_mode = True
     if opt in ("-r", "--raw_asm"):
         wrap_asm = False
+    if opt in ("-j", "--jobs"):
+        try:
+            jobs = int(arg)
+        except ValueError:
+            printUsage()
+            sys.exit(2)
 try:
     input = io.open(sys.argv[1], mode='rt')
 
@@ -60,10 +62,17 @@ except IOError:
 #       imports a symbol from a library, optionally giving it a different internal name
 #   export symbolname [as exportname]:
 #       exports a symbol, optionally giving it a different external name
+#   database {a, b, c, x, y, off}:
+#       reserves the register to hold the base of the data section. While pic is on, pointer accesses
+#       from .text to .data labels are emitted as [reg+offset] instead of calling GetVar
+#   loaddatabase:
+#       loads the base of the data section into the database register. Use it once at the
+#       start of each function that accesses .data
 
 pic_on = pic_default
 obj_name = None     #name of the resulting code
 lib_name = None     #name of the library to import from
+data_base_reg = None    #register holding the data section base, or None if the database mode is off
 
 def eprint(*args, **kwargs):#tiny little stackoverflow snippet to print to stderr
     print(*args, file=sys.stderr, **kwargs)
@@ -106,6 +115,12 @@ export_dict = {}
 import_magic_prefix = "import:"#special prefix to ensure it can't be defined as a label
 resolved_labels = {}
 symbol_refs = []    #list of (in_text_section, offset, symbol, needs_API_decision) tuples (symbol can be label, data, or import)
+position_relative_words = []    #list of (in_text_section, offset) tuples for words holding -(offset+1), rebased when chunks are merged
+data_base_refs = [] #list of (offset, symbol) tuples for text words which hold the offset of a .data label from the data section base
+data_labels = set() #labels defined in .data, collected before assembly so forward references can use the database register
+data_base_magic = '%database'#label for the start of the data section
+data_base_registers = ('a', 'b', 'c', 'x', 'y')#D is used by PIC lookups, SP and BP by the stack
+database_directive_re = re.compile(r'^[ \t]*(?:[a-zA-Z_]\w*:[ \t]*)?database\b', re.IGNORECASE | re.MULTILINE)
 
 whitespace_re = re.compile(r'^\s+')
 comment_re = re.compile(r'^[^";]*("[^"]*"[^";]*)*;')
@@ -116,72 +131,6 @@ mnemonic_re = re.compile(r'^[a-zA-Z]+')
 
 plus_re = re.compile(r'\+')
 minus_re = re.compile(r'-')
-#(MEM_OR_REG, IMM, BLANK)
-s_dst = (True, False, False)
-s_src = (True, True, False)
-s_non = (False, False, False)
-normal_instructions = {
-    #mnemonic : (opcode, src, dest)
-    'add'  : (0x02, s_src, s_dst),
-    'and'  : (0x04, s_src, s_dst),
-    'brk'  : (0x00, s_non, s_non),
-    'call' : (0x15, s_src, s_non),
-    'cmp'  : (0x0C, s_src, s_dst),
-    'dec'  : (0x04, s_dst, s_non),
-    'div'  : (0x18, s_src, s_non),
-    'hwi'  : (0x09, s_src, s_non),
-    'hwq'  : (0x1C, s_src, s_non),
-    'inc'  : (0x2A, s_dst, s_non),
-    'ja'   : (0x2E, s_src, s_non),
-    'jc'   : (0x21, s_src, s_non),
-    'jg'   : (0x0F, s_src, s_non),
-    'jge'  : (0x10, s_src, s_non),
-    'jl'   : (0x11, s_src, s_non),
-    'jle'  : (0x12, s_src, s_non),
-    'jmp'  : (0x0A, s_src, s_non),
-    'jna'  : (0x2F, s_src, s_non),
-    'jnc'  : (0x22, s_src, s_non),
-    'jno'  : (0x25, s_src, s_non),
-    'jns'  : (0x1B, s_src, s_non),
-    'jnz'  : (0x0D, s_src, s_non),
-    'jo'   : (0x24, s_src, s_non),
-    'js'   : (0x1A, s_src, s_non),
-    'jz'   : (0x0E, s_src, s_non),
-    'mov'  : (0x01, s_src, s_dst),
-    'mul'  : (0x17, s_src, s_non),
-    'neg'  : (0x19, s_dst, s_non),
-    'nop'  : (0x3F, s_non, s_non),
-    'not'  : (0x1D, s_dst, s_non),
-    'or'   : (0x05, s_src, s_dst),
-    'pop'  : (0x14, s_dst, s_non),
-    'popf' : (0x2C, s_non, s_non),
-    'push' : (0x13, s_src, s_non),
-    'pushf': (0x2D, s_non, s_non),
-    'rcl'  : (0x27, s_src, s_dst),
-    'rcr'  : (0x28, s_src, s_dst),
-    'ret'  : (0x16, (False, True, True), s_non),
-    'rol'  : (0x23, s_src, s_dst),
-    'ror'  : (0x20, s_src, s_dst),
-    'sal'  : (0x06, s_src, s_dst),
-    'sar'  : (0x29, s_src, s_dst),
-    'shl'  : (0x06, s_src, s_dst),
-    'shr'  : (0x07, s_src, s_dst),
-    'sub'  : (0x03, s_src, s_dst),
-    'test' : (0x0B, s_src, s_dst),
-    'xchg' : (0x1F, s_dst, s_dst),
-    'xor'  : (0x0C, s_src, s_dst),
-}
-
-registers = {
-    'a' : 1,
-    'b' : 2,
-    'c' : 3,
-    'd' : 4,
-    'x' : 5,
-    'y' : 6,
-    'sp': 7,
-    'bp': 8
-}
 
 def remove_comments(line):
     comment_match = comment_re.match(line)
@@ -277,6 +226,16 @@ def process_extended_directives(line):
             sys.exit(1)
         export_dict[export_name] = symbol_name
         return True
+    elif cmd == 'database':
+        global data_base_reg
+        if words[1].lower() == 'off':
+            data_base_reg = None
+        elif words[1].lower() in data_base_registers:
+            data_base_reg = registers[words[1].lower()]
+        else:
+            eprint("Error: '"+line+"' is not a valid directive (the database register must be A, B, C, X or Y)")
+            sys.exit(1)
+        return True
     else:
         return False
 
@@ -420,6 +379,7 @@ def handle_symbol_lookup(has_ptr, reg_used, imm_used, spc_used, prev_spc_used, p
             add_word(APIPICTemp)
         add_word(0xF901)#MOV offset -> D
         fixup_pt = get_current_offset()
+        position_relative_words.append((in_text_section, fixup_pt))
         add_word(0x10000-(fixup_pt+1))
         add_word(0xF015)#CALL [IMM16]
         if spc_used in import_dict:
@@ -440,6 +400,7 @@ def handle_symbol_lookup(has_ptr, reg_used, imm_used, spc_used, prev_spc_used, p
             add_word(APIPICTemp)
         add_word(0xF901)#MOV offset -> D
         fixup_pt = get_current_offset()
+        position_relative_words.append((in_text_section, fixup_pt))
         add_word(0x10000-(fixup_pt+1))
         add_word(0xF015)#CALL [IMM16]
         if spc_used in import_dict:
@@ -450,6 +411,29 @@ def handle_symbol_lookup(has_ptr, reg_used, imm_used, spc_used, prev_spc_used, p
             add_word(0)
         return (False, registers['d'], None, None, True)
 
+def handle_data_base(has_ptr, reg_used, imm_used, spc_used):
+    if (data_base_reg is None) or (not pic_on) or (not in_text_section):
+        return (has_ptr, reg_used, imm_used, spc_used, None)
+    if has_ptr and (reg_used is None) and (spc_used in data_labels):
+        return (True, data_base_reg, 0, None, spc_used)#[reg+offset], offset filled in by the fixup
+    return (has_ptr, reg_used, imm_used, spc_used, None)
+
+def process_data_base_load(line):
+    words = line.split()
+    if len(words) != 1 or words[0].lower() != 'loaddatabase':
+        return False
+    if data_base_reg is None:
+        eprint("Error: LOADDATABASE used without a DATABASE register")
+        sys.exit(1)
+    has_ptr, reg_used, imm_used, spc_used, used_pic = handle_symbol_lookup(False, None, None, data_base_magic, None, False)
+    if used_pic:
+        add_word(0x2001 | (data_base_reg << 6))#compile a MOV reg, D
+    else:#position-dependent, so the base is a plain immediate
+        add_word(0xF801 | (data_base_reg << 6))#compile a MOV reg, IMM16
+        symbol_refs.append((in_text_section, get_current_offset(), data_base_magic, False))
+        add_word(0)
+    return True
+
 def validate_operand_mode(mode_tuple, has_ptr, reg_used, imm_used, spc_used):
     mem_or_reg, imm, blank = mode_tuple
     if has_ptr and mem_or_reg:
@@ -502,6 +486,9 @@ def process_instructions(line):
     else:
         dst_has_ptr, dst_reg_used, dst_imm_used, dst_spc_used = (False, None, None, None)
 
+    src_has_ptr, src_reg_used, src_imm_used, src_spc_used, src_data_sym = handle_data_base(src_has_ptr, src_reg_used, src_imm_used, src_spc_used)
+    dst_has_ptr, dst_reg_used, dst_imm_used, dst_spc_used, dst_data_sym = handle_data_base(dst_has_ptr, dst_reg_used, dst_imm_used, dst_spc_used)
+
     src_has_ptr, src_reg_used, src_imm_used, src_spc_used, src_used_pic = handle_symbol_lookup(src_has_ptr, src_reg_used, src_imm_used, src_spc_used, None, False)
 
     dst_has_ptr, dst_reg_used, dst_imm_used, dst_spc_used, dst_used_pic = handle_symbol_lookup(dst_has_ptr, dst_reg_used, dst_imm_used, dst_spc_used, src_used_pic, src_has_ptr)
@@ -523,11 +510,15 @@ def process_instructions(line):
         symbol_refs.append((in_text_section, get_current_offset(), src_spc_used, False))
         add_word(0)
     if(src_imm_used is not None):
+        if(src_data_sym is not None):
+            data_base_refs.append((get_current_offset(), src_data_sym))
         add_word(src_imm_used)
     if(dst_spc_used is not None):
         symbol_refs.append((in_text_section, get_current_offset(), dst_spc_used, False))
         add_word(0)
     if(dst_imm_used is not None):
+        if(dst_data_sym is not None):
+            data_base_refs.append((get_current_offset(), dst_data_sym))
         add_word(dst_imm_used)
     return True
 
@@ -545,16 +536,219 @@ def parse_line(line):
         return
     if process_normal_directives(line):
         return
+    if process_data_base_load(line):
+        return
     if process_instructions(line):
         return
     #print(line)
 
-line = input.readline()
-while(line):
-    parse_line(line)
-    line = input.readline()
+#parallel assembly:
+#   the source is split into chunks at label or section boundaries. A quick serial pass
+#   runs only the sequential directives (.text/.data, pic, database, EQU, name, import, export, org)
+#   and records the state at the start of every chunk, looking only at the first tokens of a
+#   line. Worker processes then assemble each chunk from its recorded state into local word
+#   buffers, and the results are merged by rebasing offsets before the usual global fixup.
+#   Workers capture what they print, so the parent can replay it in source order and stop at
+#   the first error, like a serial run.
+
+chunks_per_job = 4
+source_lines = []
+sequential_directives = {'.text', '.data', 'pic', 'database', 'name', 'importlib', 'import', 'export', 'org'}
+
+class CapturedOutput:#collects printed text as (line index, stream name, text) tuples
+    def __init__(self, messages, stream_name):
+        self.messages = messages
+        self.stream_name = stream_name
+    def write(self, text):
+        self.messages.append((current_line, self.stream_name, text))
+    def flush(self):
+        pass
+
+current_line = 0    #index of the line a worker is assembling, for ordering captured output
+
+def replay_output(messages, before_line = None):
+    for line_index, stream_name, text in messages:
+        if before_line is not None and line_index >= before_line:
+            break
+        if stream_name == 'stderr':
+            sys.stderr.write(text)
+        else:
+            sys.stdout.write(text)
+
+def capture_sequential_state():
+    return (in_text_section, pic_on, data_base_reg, obj_name, lib_name, dict(equ_dict), dict(import_dict), dict(export_dict), list(lib_name_array))
+
+def restore_sequential_state(state):
+    global in_text_section, pic_on, data_base_reg, obj_name, lib_name, equ_dict, import_dict, export_dict, lib_name_array
+    in_text_section, pic_on, data_base_reg, obj_name, lib_name, equ_dict, import_dict, export_dict, lib_name_array = state
+    equ_dict = dict(equ_dict)
+    import_dict = dict(import_dict)
+    export_dict = dict(export_dict)
+    lib_name_array = list(lib_name_array)
+
+def is_chunk_boundary(line):
+    line = remove_comments(skip_front_whitespace(line))
+    if label_re.match(line):
+        return True
+    words = line.split()
+    return len(words) > 0 and words[0].lower() in ('.text', '.data')
+
+def split_chunks(lines, chunk_count):
+    target_len = max(1, len(lines) // chunk_count)
+    chunks = []
+    start = 0
+    index = target_len
+    while index < len(lines):
+        if is_chunk_boundary(lines[index]):
+            chunks.append((start, index))
+            start = index
+            index = index + target_len
+        else:
+            index = index + 1
+    chunks.append((start, len(lines)))
+    return chunks
+
+def scan_sequential_state(line):#mirrors parse_line, but only runs directives that later lines depend on
+    line = skip_front_whitespace(line)
+    line = remove_comments(line)
+    if not (line):
+        return
+    label_match = label_re.match(line)
+    if(label_match):
+        line = skip_front_whitespace(line[label_match.end():])
+    if len(line) >= 2 and line[:2].lower() == 'dw':
+        return
+    if process_equates(line):
+        return
+    if process_extended_directives(line):
+        return
+    process_normal_directives(line)
+
+def may_change_sequential_state(line):
+    #cheap first token test for lines scan_sequential_state could act on. Tokens with a label or a
+    #comment stuck to them are passed through. Extra lines are fine, missed ones are not
+    words = line.split(None, 2)
+    if not words:
+        return False
+    first_word = words[0].lower()
+    if first_word in sequential_directives or ':' in first_word or ';' in first_word:
+        return True
+    return len(words) > 1 and words[1].lower() == 'equ'
+
+def assemble_chunk(job):
+    #returns (error, captured output, label line indexes, result). error is (line index, exit code)
+    #for the first line that exited, or None
+    state, start, end = job
+    global text_array, data_array, resolved_labels, symbol_refs, position_relative_words, data_base_refs, current_line
+    text_array = []
+    data_array = []
+    resolved_labels = {}
+    symbol_refs = []
+    position_relative_words = []
+    data_base_refs = []
+    restore_sequential_state(state)
+    messages = []
+    label_lines = {}
+    error = None
+    real_stdout, real_stderr = sys.stdout, sys.stderr
+    sys.stdout = CapturedOutput(messages, 'stdout')
+    sys.stderr = CapturedOutput(messages, 'stderr')
+    try:
+        for current_line in range(start, end):
+            label_count = len(resolved_labels)
+            parse_line(source_lines[current_line])
+            if len(resolved_labels) != label_count:
+                label_lines[next(reversed(resolved_labels))] = current_line
+    except SystemExit as e:#report it to the parent instead of hanging the pool
+        error = (current_line, e.code)
+    finally:
+        sys.stdout, sys.stderr = real_stdout, real_stderr
+    return (error, messages, label_lines, (text_array, data_array, resolved_labels, symbol_refs, position_relative_words, data_base_refs))
+
+def merge_chunk(result):
+    chunk_text, chunk_data, chunk_labels, chunk_refs, chunk_relative_words, chunk_data_base_refs = result
+    text_base = len(text_array)
+    data_base = len(data_array)
+    for in_text, offset in chunk_relative_words:
+        if in_text:
+            chunk_text[offset] = (chunk_text[offset] - text_base)&0xFFFF
+        else:
+            chunk_data[offset] = (chunk_data[offset] - data_base)&0xFFFF
+    text_array.extend(chunk_text)
+    data_array.extend(chunk_data)
+    for label, value in chunk_labels.items():
+        label_in_text, offset = value
+        resolved_labels[label] = (label_in_text, offset + (text_base if label_in_text else data_base))
+    for in_text, offset, symbol, needs_API_decision in chunk_refs:
+        symbol_refs.append((in_text, offset + (text_base if in_text else data_base), symbol, needs_API_decision))
+    for offset, symbol in chunk_data_base_refs:
+        data_base_refs.append((offset + text_base, symbol))
+
+def assemble_parallel(lines):
+    global source_lines, last_used_text_offset, last_used_data_offset
+    source_lines = lines
+    chunk_jobs = []
+    real_stdout, real_stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = CapturedOutput([], None)
+    try:
+        for start, end in split_chunks(lines, jobs*chunks_per_job):
+            chunk_jobs.append((capture_sequential_state(), start, end))
+            for line in lines[start:end]:
+                if may_change_sequential_state(line):
+                    scan_sequential_state(line)
+    except SystemExit:#the worker for this chunk hits the same error, and reports it in order
+        pass
+    finally:
+        sys.stdout, sys.stderr = real_stdout, real_stderr
+    with multiprocessing.get_context('fork').Pool(jobs) as pool:#fork, so workers share the parsed options and source_lines
+        results = pool.map(assemble_chunk, chunk_jobs)
+    for error, messages, label_lines, result in results:
+        duplicate_line = None
+        for label, line_index in label_lines.items():
+            if label in resolved_labels and (duplicate_line is None or line_index < duplicate_line):
+                duplicate_line = line_index
+                duplicate_label = label
+        if duplicate_line is not None and (error is None or duplicate_line <= error[0]):
+            replay_output(messages, duplicate_line)
+            eprint("error: label '"+duplicate_label+"' defined twice")
+            sys.exit(1)
+        replay_output(messages)
+        if error is not None:
+            sys.exit(error[1])
+        merge_chunk(result)
+    for label_in_text, offset in resolved_labels.values():#labels set the last used offset of their section
+        if label_in_text:
+            last_used_text_offset = max(last_used_text_offset, offset)
+        else:
+            last_used_data_offset = max(last_used_data_offset, offset)
+
+def collect_data_labels(lines):#mirrors parse_line, but only tracks which section each label is in
+    section_is_text = True
+    for line in lines:
+        line = remove_comments(skip_front_whitespace(line))
+        label_match = label_re.match(line)
+        if(label_match):
+            if not section_is_text:
+                data_labels.add(label_match.group()[:-1])
+            line = skip_front_whitespace(line[label_match.end():])
+        words = line.split()
+        if len(words) > 0 and words[0].lower() == '.text':
+            section_is_text = True
+        elif len(words) > 0 and words[0].lower() == '.data':
+            section_is_text = False
+
+source = input.read()
+lines = io.StringIO(source).readlines()
+if 'database' in source.lower() and database_directive_re.search(source):#only sources using the database register need the extra pass
+    collect_data_labels(lines)
+if jobs > 1 and 'fork' in multiprocessing.get_all_start_methods():
+    assemble_parallel(lines)
+else:
+    for line in lines:
+        parse_line(line)
 
 lib_magic = '%lib_'
+resolved_labels[data_base_magic] = (False, 0)
 
 in_text_section = True
 for lib in lib_name_array:
@@ -633,6 +827,9 @@ def fix_reference(reference_tuple):
             data_data_relocs.append(offset)
 for reference in symbol_refs:
     fix_reference(reference)
+for offset, symbol in data_base_refs:#offsets from the data section base, so no base address is added
+    symbol_in_text, symbol_offset = resolved_labels[symbol]
+    text_array[offset] = (text_array[offset]+symbol_offset)&0xFFFF
 
 if wrap_asm:#set up the object file's data init symbol
     resolved_labels['%data'] = (True, len(text_array))
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+import sys
+import getopt
+import io
+import re
+import struct
+
+from mar_tables import *
+
+def printUsage():
+    print("inspector.py object_file [--dcl] [--no_disasm] [--org n]")
+    print("    dcl: read the object from DW statements instead of raw output")
+    print("    no_disasm: only print the header, exports and word usage")
+    print("    org: base address used by position-dependent objects (defaults to 0x200)")
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+#object file layout, as written by assembler.py when wrap_asm is on:
+#   DW 0xCB07
+#   DW offset from this word to the export trie
+#   DW "name", 0
+#   text (code, then library names and import stubs)
+#   %data:
+#   DW data_len
+#   ;data
+#   offsets for data locations which point to text section
+#   DW 0xFFFF
+#   offsets for data locations which point to data section
+#   DW 0xFFFF
+#   export trie
+
+object_magic = 0xCB07
+end_of_relocs = 0xFFFF
+
+api_names = {
+    APIGetMyAddress : 'GetMyAddress',
+    APIGetRelativeOffset : 'GetRelativeOffset',
+    APIPrepareTable : 'PrepareTable',
+    APIGetTableValue : 'GetTableValue',
+    APIRestoreOldTable : 'RestoreOldTable',
+    APIGetSymbol : 'GetSymbol',
+    APIGetVar : 'GetVar',
+    APIPICTemp : 'PIC_Temp',
+}
+pic_lookup_apis = (APIGetRelativeOffset, APIGetVar, APIGetSymbol)
+
+register_names = {}
+for reg_name, reg_value in registers.items():
+    register_names[reg_value] = reg_name.upper()
+
+#reverse index of normal_instructions, indexed by opcode. Opcodes shared by several
+#mnemonics keep them all so the operands can pick between them
+opcode_table = [None]*64
+for mnemonic, value in normal_instructions.items():
+    opcode, src_mode, dst_mode = value
+    if opcode_table[opcode] is None:
+        opcode_table[opcode] = []
+    opcode_table[opcode].append((mnemonic.upper(), src_mode, dst_mode))
+
+#operand field -> (is valid, takes an extra word)
+operand_table = [(False, False)]*32
+for operand in range(0, 17):
+    operand_table[operand] = (True, False)
+for operand in range(17, 25):
+    operand_table[operand] = (True, True)
+operand_table[0x1E] = (True, True)
+operand_table[0x1F] = (True, True)
+
+def read_words(file_name, dcl):
+    try:
+        if dcl:
+            with io.open(file_name, mode='rt') as f:
+                words = []
+                for line in f:
+                    if line.strip()[:2].upper() == 'DW':
+                        words.extend(int(word, 0) for word in re.findall(r'0x[0-9a-fA-F]+|\d+', line[line.upper().index('DW')+2:]))
+                return words
+        with io.open(file_name, mode='rb') as f:
+            data = f.read()
+    except IOError:
+        eprint("Error: object file '"+file_name+"' cannot be opened")
+        sys.exit(2)
+    if len(data) & 1:
+        eprint("Error: object file has an odd number of bytes")
+        sys.exit(1)
+    return list(struct.unpack('>%dH' % (len(data)//2), data))
+
+def read_string(words, index):#returns (string, index of the terminating 0)
+    chars = []
+    while index < len(words) and words[index] != 0:
+        if 32 <= words[index] < 127:
+            chars.append(chr(words[index]))
+        else:
+            chars.append('\\x{0:04x}'.format(words[index]))
+        index = index + 1
+    return (''.join(chars), index)
+
+def walk_trie(words, start):
+    #follows the same steps as GetDictVal in the Relative Offset API, so the names are the ones
+    #a lookup at runtime would see. Returns a list of (name, object offset) tuples
+    exports = []
+    visited = set()
+    pending = [(start, '')]
+    while pending:
+        pos, prefix = pending.pop()
+        while pos < len(words) and pos not in visited:
+            visited.add(pos)
+            next_entry = words[pos]
+            name, end = read_string(words, pos + 1)
+            marker = end + 1
+            if marker >= len(words):
+                break
+            if words[marker] == 0:#leaf, value is relative to its own word
+                if marker + 1 < len(words):
+                    exports.append((prefix + name, (marker + 1 + words[marker + 1]) & 0xFFFF))
+            else:#the sub-list starts at the marker
+                pending.append((marker, prefix + name))
+            if next_entry == 0:
+                break
+            pos = (pos + next_entry) & 0xFFFF
+    return exports
+
+class ObjectFile:
+    def __init__(self, words):
+        if len(words) < 3 or words[0] != object_magic:
+            eprint("Error: not an object file (missing 0xCB07 magic)")
+            sys.exit(1)
+        self.words = words
+        self.trie_start = (1 + words[1]) & 0xFFFF
+        self.name, name_end = read_string(words, 2)
+        self.text_start = name_end + 1
+        if self.trie_start >= len(words) or self.trie_start <= self.text_start:
+            eprint("Error: export pointer is out of range")
+            sys.exit(1)
+        self.exports = walk_trie(words, self.trie_start)
+        if not self.exports:
+            eprint("Error: export trie has no %data entry")
+            sys.exit(1)
+        self.data_label = self.exports[0][1]#%data is always added to the trie first
+        if not (self.text_start <= self.data_label < self.trie_start):
+            eprint("Error: %data points outside of the object")
+            sys.exit(1)
+        self.text = words[self.text_start:self.data_label]
+        self.data_start = self.data_label + 1
+        self.data = words[self.data_start:self.data_start + words[self.data_label]]
+        index = self.data_start + len(self.data)
+        self.data_text_relocs, index = self.read_relocs(index)
+        self.data_data_relocs, index = self.read_relocs(index)
+        self.relocs_end = index
+
+    def read_relocs(self, index):
+        relocs = []
+        while index < self.trie_start and self.words[index] != end_of_relocs:
+            relocs.append(self.words[index])
+            index = index + 1
+        if index >= self.trie_start:
+            eprint("Error: relocation list is not terminated")
+            sys.exit(1)
+        return (relocs, index + 1)
+
+    def is_string(self, start, end):#a printable string whose terminating 0 is before end
+        string, string_end = read_string(self.text, start)
+        return string_end < end and string_end > start and all(32 <= word < 127 for word in self.text[start:string_end])
+
+    def find_stubs(self, text_base):
+        #library names and import stubs are appended to the end of the text section as
+        #zero-terminated strings. Each stub starts with an offset to its library name.
+        #Returns (libs start, stubs start, {stub offset: (lib name, import name)})
+        records = []
+        end = len(self.text)
+        while end > 1 and self.text[end - 1] == 0:
+            start = end - 1
+            while start > 0 and self.text[start - 1] != 0:
+                start = start - 1
+            if end - start < 2:
+                break
+            records.append((start, end))
+            end = start
+        stubs = {}
+        stubs_start = len(self.text)
+        libs_start = len(self.text)
+        for start, end in records:#last record first
+            lib_offset = (start + self.text[start] - text_base) & 0xFFFF
+            if lib_offset >= start or not self.is_string(lib_offset, start) or not self.is_string(start + 1, end):
+                break
+            stubs[start] = (read_string(self.text, lib_offset)[0], read_string(self.text, start + 1)[0])
+            stubs_start = start
+            libs_start = min(libs_start, lib_offset)
+        if not stubs:
+            return (len(self.text), len(self.text), {})
+        return (libs_start, stubs_start, stubs)
+
+def operand_fits(mode_tuple, operand):
+    mem_or_reg, imm, blank = mode_tuple
+    if operand == 0:
+        return blank or mode_tuple == s_non
+    if operand == 0x1F:
+        return imm
+    return mem_or_reg
+
+def format_operand(operand, extra):
+    if operand == 0:
+        return None
+    if operand <= 8:
+        return register_names[operand]
+    if operand <= 16:
+        return '[' + register_names[operand - 8] + ']'
+    if operand <= 24:
+        if extra >= 0x8000:
+            return '[{0}-{1:#06x}]'.format(register_names[operand - 16], 0x10000 - extra)
+        return '[{0}+{1:#06x}]'.format(register_names[operand - 16], extra)
+    if operand == 0x1E:
+        return '[{0:#06x}]'.format(extra)
+    return '{0:#06x}'.format(extra)
+
+def disassemble(code, stubs, labels, pic_counts):
+    #linear sweep over code. Yields (offset, words, text, comment) tuples, one per instruction.
+    #pic_counts gets the number of words spent on PIC lookups and PIC_Temp saves
+    index = 0
+    code_len = len(code)
+    lookup_end = None#(index after the last lookup, its API, its offset word)
+    while index < code_len:
+        word = code[index]
+        entries = opcode_table[word & 0x3F]
+        src = word >> 11
+        dst = (word >> 6) & 0x1F
+        src_valid, src_extra = operand_table[src]
+        dst_valid, dst_extra = operand_table[dst]
+        length = 1 + src_extra + dst_extra
+        mnemonic = None
+        if entries is not None and src_valid and dst_valid and index + length <= code_len:
+            for entry_mnemonic, src_mode, dst_mode in entries:
+                if operand_fits(src_mode, src) and operand_fits(dst_mode, dst):
+                    mnemonic = entry_mnemonic
+                    break
+        if mnemonic is None:#not an instruction, probably data in the text section
+            yield (index, code[index:index + 1], 'DW {0:#06x}'.format(word), None)
+            index = index + 1
+            continue
+        extra_index = index + 1
+        src_text = format_operand(src, code[extra_index] if src_extra else 0)
+        extra_index = extra_index + src_extra
+        dst_text = format_operand(dst, code[extra_index] if dst_extra else 0)
+        if dst_text is not None:
+            text = mnemonic + ' ' + dst_text + ', ' + src_text
+        elif src_text is not None:
+            text = mnemonic + ' ' + src_text
+        else:
+            text = mnemonic
+        comment = None
+        if lookup_end is not None and index == lookup_end[0] and length == 1 and 1 <= dst <= 8:
+            if (word & 0xF83F) == 0x2002 and index + 1 < code_len and 0x0C in (code[index + 1] >> 11, (code[index + 1] >> 6) & 0x1F):
+                comment = 'PIC, adds the register of a [reg+label] lookup'
+            elif (word & 0xF83F) == 0x2001 and lookup_end[1] == APIGetVar and lookup_end[2] == 0:
+                comment = 'PIC, loads the database register'
+            if comment is not None:
+                pic_counts['lookup'] = pic_counts['lookup'] + 1
+        if word == 0xF901 and index + 3 < code_len and code[index + 2] == 0xF015 and code[index + 3] in pic_lookup_apis:
+            api = code[index + 3]
+            pic_counts['lookup'] = pic_counts['lookup'] + 4
+            lookup_end = (index + 4, api, code[index + 1])
+            if api == APIGetVar:
+                comment = 'data+{0:#06x}'.format(code[index + 1])
+            else:
+                target = (index + 2 + code[index + 1]) & 0xFFFF#the offset is relative to the word after it
+                if api == APIGetSymbol and target in stubs:
+                    comment = 'import {1} from {0}'.format(*stubs[target])
+                else:
+                    comment = labels.get(target, 'text+{0:#06x}'.format(target))
+        elif word in (0x6781, 0x2781) and code[index + 1] == APIPICTemp:
+            pic_counts['temp'] = pic_counts['temp'] + 2
+            comment = 'PIC_Temp'
+        elif word == 0xF015 and code[index + 1] in api_names:
+            comment = api_names[code[index + 1]]
+        yield (index, code[index:index + length], text, comment)
+        index = index + length
+
+def print_disassembly(obj, libs_start, stubs_start, stubs, pic_counts):
+    labels = {}
+    for export_name, target in obj.exports[1:]:
+        if obj.text_start <= target < obj.data_label:
+            labels[target - obj.text_start] = export_name
+    print("\n.text")
+    for offset, words, text, comment in disassemble(obj.text[:libs_start], stubs, labels, pic_counts):
+        if offset in labels:
+            print(labels[offset] + ':')
+        line = '    {0:04x}: {1:<15} {2}'.format(offset, ' '.join('{0:04x}'.format(word) for word in words), text)
+        if comment:
+            line = line + ' ;' + comment
+        print(line)
+    offset = libs_start
+    while offset < len(obj.text):
+        string, end = read_string(obj.text, offset)
+        if offset in stubs:
+            print('    {0:04x}: DW {1:#06x}, "{2}", 0 ;import stub, library {3}'.format(offset, obj.text[offset], stubs[offset][1], stubs[offset][0]))
+            end = read_string(obj.text, offset + 1)[1]
+        else:
+            print('    {0:04x}: DW "{1}", 0 ;library name'.format(offset, string))
+        offset = end + 1
+    print("\n.data")
+    text_relocs = set(obj.data_text_relocs)
+    data_relocs = set(obj.data_data_relocs)
+    for offset in range(len(obj.data)):
+        line = '    {0:04x}: DW {1:#06x}'.format(offset, obj.data[offset])
+        if offset in text_relocs:
+            line = line + ' ;-> text'
+        elif offset in data_relocs:
+            line = line + ' ;-> data'
+        print(line)
+
+def print_usage_report(obj, libs_start, stubs_start, pic_counts):
+    total = len(obj.words)
+    def report(title, count):
+        print('  {0:<22} {1:6d} words {2:6.1f}%'.format(title, count, 100.0*count/total))
+    print("\nword usage:")
+    report('header', obj.text_start)
+    report('code', libs_start)
+    report('  PIC lookups', pic_counts['lookup'])
+    report('  PIC_Temp saves', pic_counts['temp'])
+    report('library names', stubs_start - libs_start)
+    report('import stubs', len(obj.text) - stubs_start)
+    report('%data header', 1)
+    report('data', len(obj.data))
+    report('relocations', obj.relocs_end - obj.data_start - len(obj.data))
+    report('unaccounted', obj.trie_start - obj.relocs_end)
+    report('export trie', total - obj.trie_start)
+    print('  {0:<22} {1:6d} words'.format('total', total))
+
+if __name__ == '__main__':
+    if(len(sys.argv) < 2):
+        printUsage()
+        sys.exit(2)
+
+    dcl_mode = False
+    show_disasm = True
+    org_value = 0x200
+
+    try:
+        opts, args = getopt.getopt(sys.argv[2:], "dno:", ["dcl", "no_disasm", "org="])
+    except getopt.GetoptError:
+        printUsage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ("-d", "--dcl"):
+            dcl_mode = True
+        if opt in ("-n", "--no_disasm"):
+            show_disasm = False
+        if opt in ("-o", "--org"):
+            org_value = int(arg, 0)
+
+    obj = ObjectFile(read_words(sys.argv[1], dcl_mode))
+    libs_start, stubs_start, stubs = obj.find_stubs(0)
+    if not stubs:#position-dependent objects point at absolute addresses
+        libs_start, stubs_start, stubs = obj.find_stubs(org_value + obj.text_start)
+
+    print("name: " + (obj.name if obj.name else "(none)"))
+    print("text: {0} words, data: {1} words, {2} data->text and {3} data->data relocations".format(len(obj.text), len(obj.data), len(obj.data_text_relocs), len(obj.data_data_relocs)))
+    print("exports:")
+    for export_name, target in obj.exports[1:]:
+        if target < obj.data_start:#%data itself is the last word of the text section
+            print('  {0:<22} text+{1:#06x}'.format(export_name, target - obj.text_start))
+        else:
+            print('  {0:<22} data+{1:#06x}'.format(export_name, target - obj.data_start))
+    for stub_offset, value in sorted(stubs.items()):
+        print('import {1} from {0} (stub at text+{2:#06x})'.format(value[0], value[1], stub_offset))
+
+    pic_counts = {'lookup' : 0, 'temp' : 0}
+    if show_disasm:
+        print_disassembly(obj, libs_start, stubs_start, stubs, pic_counts)
+    else:
+        for item in disassemble(obj.text[:libs_start], stubs, {}, pic_counts):
+            pass
+    print_usage_report(obj, libs_start, stubs_start, pic_counts)
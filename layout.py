@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+import sys
+import getopt
+import io
+import os
+import struct
+
+from inspector import ObjectFile, read_words, disassemble
+
+def printUsage():
+    print("layout.py map_file [--dcl] [--org n] [--table table_file] [--image image_file]")
+    print("    dcl: read objects from DW statements instead of raw output")
+    print("    org: base address position-dependent objects were assembled with (defaults to 0x200)")
+    print("    table: write the overlay table as assembler source for a loader")
+    print("    image: write the overlay image (every group, in table order) as raw output")
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+#memory map directives (one per line, ';' starts a comment):
+#   memory start end:
+#       the usable address range (defaults to 0x0000 0xFFFF)
+#   reserve start end [name]:
+#       keeps a range free of objects
+#   stack size:
+#       reserves size words at the top of memory for the stack (defaults to 0x400)
+#   object file [at address]:
+#       places an object which stays in memory, optionally at a fixed address. Objects assembled
+#       with --pdc only work at the org they were assembled with, so they need 'at org'
+#   overlay group file:
+#       adds an object to an overlay group. Only one group is in memory at a time, so all
+#       groups share one region which a loader fills from the overlay image on demand
+#   overlay_image memory [address]:
+#       keeps the overlay image in memory, optionally at a fixed address
+#   overlay_image floppy first_sector:
+#       the overlay image is written to the floppy starting at first_sector
+#
+#Reserved ranges and the stack may overlap each other. Each file can only be used once.
+#The planner only writes the overlay table and image. The loader that copies a group into the
+#overlay region is not included; it finds each member by the load address, image offset and
+#length in the table, and each member's exports through its own object header.
+#0x0000-0x001F always holds the Relative Offset API and is never used for objects.
+
+api_area = (0x0000, 0x001F)
+default_stack_size = 0x400
+overlay_region_name = '(overlay region)'
+overlay_image_name = '(overlay image)'
+floppy_sector_words = 512
+
+class Block:#a range of memory that has to be placed
+    def __init__(self, name, size, address = None):
+        self.name = name
+        self.size = size
+        self.address = address
+
+def parse_int(word, line):
+    try:
+        return int(word, 0)
+    except ValueError:
+        eprint("Error: '"+line+"' is not a valid directive")
+        sys.exit(1)
+
+def parse_map(map_name):
+    #returns (memory range, reserved ranges, stack size, resident objects, overlay groups, overlay image)
+    #the overlay image is ('memory', address or None), ('floppy', first sector) or None
+    memory = (0x0000, 0xFFFF)
+    reserves = [(api_area[0], api_area[1], 'Relative Offset API')]
+    stack_size = default_stack_size
+    objects = []
+    overlays = {}
+    overlay_image = None
+    try:
+        map_file = io.open(map_name, mode='rt')
+    except IOError:
+        eprint("Error: memory map cannot be opened")
+        sys.exit(2)
+    for line in map_file:
+        line = line.split(';')[0].strip()
+        words = line.split()
+        if len(words) < 1:
+            continue
+        cmd = words[0].lower()
+        if cmd == 'memory' and len(words) == 3:
+            memory = (parse_int(words[1], line), parse_int(words[2], line))
+        elif cmd == 'reserve' and len(words) in (3, 4):
+            name = words[3] if len(words) == 4 else '(reserved)'
+            reserves.append((parse_int(words[1], line), parse_int(words[2], line), name))
+        elif cmd == 'stack' and len(words) == 2:
+            stack_size = parse_int(words[1], line)
+        elif cmd == 'object' and len(words) == 2:
+            objects.append((words[1], None))
+        elif cmd == 'object' and len(words) == 4 and words[2].lower() == 'at':
+            objects.append((words[1], parse_int(words[3], line)))
+        elif cmd == 'overlay' and len(words) == 3:
+            if words[1] not in overlays:
+                overlays[words[1]] = []
+            overlays[words[1]].append(words[2])
+        elif cmd == 'overlay_image' and len(words) == 2 and words[1].lower() == 'memory':
+            overlay_image = ('memory', None)
+        elif cmd == 'overlay_image' and len(words) == 3 and words[1].lower() in ('memory', 'floppy'):
+            overlay_image = (words[1].lower(), parse_int(words[2], line))
+        else:
+            eprint("Error: '"+line+"' is not a valid directive")
+            sys.exit(1)
+    map_file.close()
+    if memory[0] > memory[1] or memory[1] > 0xFFFF:
+        eprint("Error: memory range is not inside 0x0000-0xFFFF")
+        sys.exit(1)
+    if overlays and overlay_image is None:
+        eprint("Error: overlay groups need an overlay_image directive saying where the image is kept")
+        sys.exit(1)
+    if stack_size > 0:
+        reserves.append((memory[1] - stack_size + 1, memory[1], '(stack)'))
+    return (memory, reserves, stack_size, objects, overlays, overlay_image)
+
+def free_ranges(memory, used):
+    #returns the (start, end) ranges of memory not covered by the used (start, end, name) ranges
+    free = []
+    next_free = memory[0]
+    for start, end, name in sorted(used):
+        if start > next_free:
+            free.append((next_free, min(start - 1, memory[1])))
+        next_free = max(next_free, end + 1)
+    if next_free <= memory[1]:
+        free.append((next_free, memory[1]))
+    return free
+
+def merge_reserves(memory, reserves):
+    #clips the reserved ranges to memory and merges the ones that overlap
+    merged = []
+    for start, end, name in sorted(reserves):
+        start = max(start, memory[0])
+        end = min(end, memory[1])
+        if start > end:
+            continue#outside of the usable memory, nothing to keep free
+        if merged and start <= merged[-1][1]:
+            previous = merged[-1]
+            merged[-1] = (previous[0], max(previous[1], end), previous[2] + ' + ' + name)
+        else:
+            merged.append((start, end, name))
+    return merged
+
+def text_reloc_values(obj):
+    return [obj.data[offset] for offset in obj.data_text_relocs if offset < len(obj.data)]
+
+def absolute_addresses(obj, text_base):
+    #returns the immediate targets of jumps and calls and the [imm] pointers above the API area.
+    #PIC code reaches its labels through lookups, which --pdc code never has, so an object with
+    #lookups returns none. Import stub offsets are skipped, PIC calls imports through them
+    libs_start, stubs_start, stubs = obj.find_stubs(0)
+    libs_start = min(libs_start, obj.find_stubs(text_base)[0])
+    pic_counts = {'lookup': 0, 'temp': 0}
+    addresses = []
+    for offset, words, text, comment in disassemble(obj.text[:libs_start], {}, {}, pic_counts):
+        mnemonic = text.split()[0]
+        if mnemonic == 'DW':
+            continue
+        is_jump = mnemonic == 'CALL' or mnemonic.startswith('J')
+        extra_index = 1
+        for operand in (words[0] >> 11, (words[0] >> 6) & 0x1F):#extra words are src first
+            if 17 <= operand <= 24 or operand >= 0x1E:
+                value = words[extra_index]
+                extra_index = extra_index + 1
+                if value in stubs:
+                    continue
+                if (operand == 0x1E and value >= 0x20) or (operand == 0x1F and is_jump):
+                    addresses.append(value)
+    if pic_counts['lookup'] > 0:
+        return []
+    return addresses
+
+def position_dependent_org(obj, org):
+    #returns org if obj looks like it was assembled with --pdc at that org, else None. Import stubs,
+    #data->text relocations, jumps and pointers hold absolute addresses in such objects
+    text_base = org + obj.text_start
+    if not obj.find_stubs(0)[2] and obj.find_stubs(text_base)[2]:
+        return org
+    relocs = text_reloc_values(obj)
+    if relocs and all(text_base <= value <= text_base + len(obj.text) for value in relocs) and is_position_dependent(obj):
+        return org
+    if any(org <= value < org + len(obj.words) for value in absolute_addresses(obj, text_base)):
+        return org
+    return None
+
+def is_position_dependent(obj):
+    #true when some data->text relocation is an absolute address. In position-independent objects
+    #they are offsets into the text section, or negative offsets from PIC lookups in .data
+    lowest_negative = 0x10000 - len(obj.data) - 1
+    return any(len(obj.text) < value < lowest_negative for value in text_reloc_values(obj))
+
+def check_overlaps(used):
+    previous = None
+    for current in sorted(used):
+        if previous is not None and current[0] <= previous[1]:
+            eprint("Error: {0} ({1:#06x}-{2:#06x}) overlaps {3} ({4:#06x}-{5:#06x})".format(current[2], current[0], current[1], previous[2], previous[0], previous[1]))
+            sys.exit(1)
+        if previous is None or current[1] > previous[1]:
+            previous = current
+
+def pack(memory, used, blocks):
+    #best fit decreasing: the largest blocks are placed first, each one in the smallest free
+    #range it fits in. Fixed blocks must already be in used
+    for block in sorted(blocks, key=lambda block: -block.size):
+        best = None
+        for start, end in free_ranges(memory, used):
+            if end - start + 1 >= block.size and (best is None or end - start < best[1] - best[0]):
+                best = (start, end)
+        if best is None:
+            largest = max([end - start + 1 for start, end in free_ranges(memory, used)] + [0])
+            eprint("Error: {0} needs {1} words, the largest free range is {2} words".format(block.name, block.size, largest))
+            sys.exit(1)
+        block.address = best[0]
+        used.append((block.address, block.address + block.size - 1, block.name))
+
+def write_table(table_name, region, groups, image_kind, image_location, loaded):
+    #groups are listed as (first member, member count), members as
+    #(load address, offset into the overlay image, length, name)
+    member_count = sum(len(group[3]) for group in groups)
+    with io.open(table_name, mode='wt') as f:
+        f.write(";overlay table generated by layout.py\n")
+        f.write("OverlayBase EQU {0:#06x}\n".format(region.address if region else 0))
+        f.write("OverlaySize EQU {0:#06x}\n".format(region.size if region else 0))
+        f.write("OverlayCount EQU {0}\n".format(len(groups)))
+        f.write("OverlayMemberCount EQU {0}\n".format(member_count))
+        f.write("OverlayImageOnFloppy EQU {0}\n".format(1 if image_kind == 'floppy' else 0))
+        f.write("OverlayImage EQU {0:#06x};{1}\n".format(image_location if image_location is not None else 0, 'first sector' if image_kind == 'floppy' else 'address'))
+        f.write("OverlaySectorSize EQU {0}\n".format(floppy_sector_words))
+        f.write(".data\n")
+        f.write("overlay_groups:;first member, member count\n")
+        first_member = 0
+        for group_name, group_offset, group_size, members in groups:
+            f.write("    DW {0}, {1};{2}\n".format(first_member, len(members), group_name))
+            first_member = first_member + len(members)
+        f.write("overlay_members:;load address, image offset, length, name\n")
+        member_index = 0
+        for group_name, group_offset, group_size, members in groups:
+            for file_name, address, image_offset in members:
+                f.write("    DW {0:#06x}, {1:#06x}, {2:#06x}, overlay_name_{3}\n".format(address, image_offset, len(loaded[file_name].words), member_index))
+                member_index = member_index + 1
+        member_index = 0
+        for group_name, group_offset, group_size, members in groups:
+            for file_name, address, image_offset in members:
+                f.write("overlay_name_{0}: DW \"{1}\", 0\n".format(member_index, os.path.basename(file_name)))
+                member_index = member_index + 1
+
+def write_image(image_name, groups, loaded):
+    byteout = bytearray()
+    for group_name, image_offset, group_size, members in groups:
+        for file_name, address, member_offset in members:
+            words = loaded[file_name].words
+            byteout.extend(struct.pack('>%dH' % len(words), *words))
+    with io.open(image_name, mode='wb') as f:
+        f.write(byteout)
+
+if __name__ == '__main__':
+    if(len(sys.argv) < 2):
+        printUsage()
+        sys.exit(2)
+
+    dcl_mode = False
+    org_value = 0x200
+    table_name = None
+    image_name = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[2:], "do:t:i:", ["dcl", "org=", "table=", "image="])
+    except getopt.GetoptError:
+        printUsage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ("-d", "--dcl"):
+            dcl_mode = True
+        if opt in ("-o", "--org"):
+            org_value = int(arg, 0)
+        if opt in ("-t", "--table"):
+            table_name = arg
+        if opt in ("-i", "--image"):
+            image_name = arg
+
+    memory, reserves, stack_size, objects, overlays, overlay_image = parse_map(sys.argv[1])
+
+    loaded = {}
+    listed_as = {}
+    for file_name, address in objects:
+        if file_name in listed_as:
+            eprint("Error: {0} is used more than once ({1} and an object)".format(file_name, listed_as[file_name]))
+            sys.exit(1)
+        listed_as[file_name] = 'an object'
+        loaded[file_name] = ObjectFile(read_words(file_name, dcl_mode))
+    for group_name, members in overlays.items():
+        for file_name in members:
+            if file_name in listed_as:
+                eprint("Error: {0} is used more than once ({1} and overlay {2})".format(file_name, listed_as[file_name], group_name))
+                sys.exit(1)
+            listed_as[file_name] = 'overlay ' + group_name
+            loaded[file_name] = ObjectFile(read_words(file_name, dcl_mode))
+
+    for file_name, address in objects:
+        assembled_org = position_dependent_org(loaded[file_name], address if address is not None else org_value)
+        if assembled_org is None and address is not None and address != org_value:
+            assembled_org = position_dependent_org(loaded[file_name], org_value)
+        if assembled_org is not None and assembled_org != address:
+            eprint("Error: {0} is position dependent, place it with 'object {0} at {1:#06x}' or assemble it without --pdc".format(file_name, assembled_org))
+            sys.exit(1)
+        if assembled_org is None and is_position_dependent(loaded[file_name]):
+            eprint("Error: {0} is position dependent but was not assembled with org {1:#06x}, give its org with --org or assemble it without --pdc".format(file_name, org_value if address is None else address))
+            sys.exit(1)
+    for group_name, members in overlays.items():
+        for file_name in members:
+            if position_dependent_org(loaded[file_name], org_value) is not None or is_position_dependent(loaded[file_name]):
+                eprint("Error: {0} is position dependent and cannot be in overlay {1}, assemble it without --pdc".format(file_name, group_name))
+                sys.exit(1)
+
+    if stack_size > memory[1] - memory[0] + 1:
+        eprint("Error: stack is larger than memory")
+        sys.exit(1)
+    used = merge_reserves(memory, reserves)
+    blocks = []
+    for file_name, address in objects:#fixed objects may not overlap the reserved ranges or each other
+        block = Block(file_name, len(loaded[file_name].words), address)
+        if address is None:
+            blocks.append(block)
+        elif address < memory[0] or address + block.size - 1 > memory[1]:
+            eprint("Error: {0} at {1:#06x} does not fit in memory".format(file_name, address))
+            sys.exit(1)
+        else:
+            used.append((address, address + block.size - 1, file_name))
+    check_overlaps(used)
+
+    groups = []#(group name, image offset, size, [(file name, address)])
+    image_offset = 0
+    for group_name, members in overlays.items():
+        group_size = sum(len(loaded[file_name].words) for file_name in members)
+        groups.append((group_name, image_offset, group_size, members))
+        image_offset = image_offset + group_size
+    region = None
+    image_block = None
+    if groups:
+        region = Block(overlay_region_name, max(group[2] for group in groups))
+        blocks.append(region)
+        if overlay_image[0] == 'memory':
+            image_block = Block(overlay_image_name, image_offset, overlay_image[1])
+            if image_block.address is None:
+                blocks.append(image_block)
+            else:
+                used.append((image_block.address, image_block.address + image_block.size - 1, overlay_image_name))
+                check_overlaps(used)
+
+    pack(memory, used, blocks)
+
+    for index in range(len(groups)):#objects in a group are packed back to back from the region base
+        group_name, group_offset, group_size, members = groups[index]
+        address = region.address
+        member_offset = group_offset
+        placed = []
+        for file_name in members:
+            placed.append((file_name, address, member_offset))
+            address = address + len(loaded[file_name].words)
+            member_offset = member_offset + len(loaded[file_name].words)
+        groups[index] = (group_name, group_offset, group_size, placed)
+
+    print("memory map:")
+    ranges = used + [(start, end, '(free)') for start, end in free_ranges(memory, used)]
+    for start, end, name in sorted(ranges):
+        print("  {0:#06x}-{1:#06x} {2:6d} words  {3}".format(start, end, end - start + 1, name))
+    if groups and image_block is not None:
+        print("overlay image: {0} words in memory at {1:#06x}".format(image_block.size, image_block.address))
+    elif groups:
+        print("overlay image: {0} words on the floppy, sectors {1}-{2}".format(image_offset, overlay_image[1], overlay_image[1] + max(0, image_offset - 1) // floppy_sector_words))
+    for group_name, group_offset, group_size, members in groups:
+        print("overlay {0}: {1} words, image offset {2:#06x}".format(group_name, group_size, group_offset))
+        for file_name, address, member_offset in members:
+            print("  {0:#06x}-{1:#06x} {2:6d} words  {3} (image offset {4:#06x})".format(address, address + len(loaded[file_name].words) - 1, len(loaded[file_name].words), file_name, member_offset))
+    total = memory[1] - memory[0] + 1
+    free = sum(end - start + 1 for start, end in free_ranges(memory, used))
+    print("{0} of {1} words used, {2} free".format(total - free, total, free))
+
+    if table_name:
+        image_kind, image_location = overlay_image if overlay_image else (None, None)
+        if image_block is not None:
+            image_location = image_block.address
+        write_table(table_name, region, groups, image_kind, image_location, loaded)
+    if image_name:
+        write_image(image_name, groups, loaded)
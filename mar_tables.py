@@ -0,0 +1,78 @@
+#tables shared by assembler.py and inspector.py
+
+#Special API pointer addresses
+APIGetMyAddress = 0x0001
+APIGetRelativeOffset = 0x0002
+APIPrepareTable = 0x0003
+APIGetTableValue = 0x0004
+APIRestoreOldTable = 0x0005
+APIGetSymbol = 0x0006
+APIGetVar = 0x0007#not implemented yet in Relative Offset API version 0.3
+APIPICTemp = 0x001B#not implemented yet either
+
+#(MEM_OR_REG, IMM, BLANK)
+s_dst = (True, False, False)
+s_src = (True, True, False)
+s_non = (False, False, False)
+normal_instructions = {
+    #mnemonic : (opcode, src, dest)
+    'add'  : (0x02, s_src, s_dst),
+    'and'  : (0x04, s_src, s_dst),
+    'brk'  : (0x00, s_non, s_non),
+    'call' : (0x15, s_src, s_non),
+    'cmp'  : (0x0C, s_src, s_dst),
+    'dec'  : (0x04, s_dst, s_non),
+    'div'  : (0x18, s_src, s_non),
+    'hwi'  : (0x09, s_src, s_non),
+    'hwq'  : (0x1C, s_src, s_non),
+    'inc'  : (0x2A, s_dst, s_non),
+    'ja'   : (0x2E, s_src, s_non),
+    'jc'   : (0x21, s_src, s_non),
+    'jg'   : (0x0F, s_src, s_non),
+    'jge'  : (0x10, s_src, s_non),
+    'jl'   : (0x11, s_src, s_non),
+    'jle'  : (0x12, s_src, s_non),
+    'jmp'  : (0x0A, s_src, s_non),
+    'jna'  : (0x2F, s_src, s_non),
+    'jnc'  : (0x22, s_src, s_non),
+    'jno'  : (0x25, s_src, s_non),
+    'jns'  : (0x1B, s_src, s_non),
+    'jnz'  : (0x0D, s_src, s_non),
+    'jo'   : (0x24, s_src, s_non),
+    'js'   : (0x1A, s_src, s_non),
+    'jz'   : (0x0E, s_src, s_non),
+    'mov'  : (0x01, s_src, s_dst),
+    'mul'  : (0x17, s_src, s_non),
+    'neg'  : (0x19, s_dst, s_non),
+    'nop'  : (0x3F, s_non, s_non),
+    'not'  : (0x1D, s_dst, s_non),
+    'or'   : (0x05, s_src, s_dst),
+    'pop'  : (0x14, s_dst, s_non),
+    'popf' : (0x2C, s_non, s_non),
+    'push' : (0x13, s_src, s_non),
+    'pushf': (0x2D, s_non, s_non),
+    'rcl'  : (0x27, s_src, s_dst),
+    'rcr'  : (0x28, s_src, s_dst),
+    'ret'  : (0x16, (False, True, True), s_non),
+    'rol'  : (0x23, s_src, s_dst),
+    'ror'  : (0x20, s_src, s_dst),
+    'sal'  : (0x06, s_src, s_dst),
+    'sar'  : (0x29, s_src, s_dst),
+    'shl'  : (0x06, s_src, s_dst),
+    'shr'  : (0x07, s_src, s_dst),
+    'sub'  : (0x03, s_src, s_dst),
+    'test' : (0x0B, s_src, s_dst),
+    'xchg' : (0x1F, s_dst, s_dst),
+    'xor'  : (0x0C, s_src, s_dst),
+}
+
+registers = {
+    'a' : 1,
+    'b' : 2,
+    'c' : 3,
+    'd' : 4,
+    'x' : 5,
+    'y' : 6,
+    'sp': 7,
+    'bp': 8
+}